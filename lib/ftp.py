@@ -4,11 +4,17 @@ Handles the downloading of data from FTP sites.
 
 import os
 import logging
+import threading
 from ftplib import FTP
 
+import status
+from transfer import WRITE_BUFFER_SIZE, TeeWriter, update_from_file
+
 class PortalFTP:
     """
     The PortalFTP class provides for simple retrieval of data from FTP servers.
+    FTP transfers can't be split into ranges, so FTP is preferred only when
+    a file isn't also available via HTTP or S3.
     """
     def __init__(self, blocksize=100000):
         """
@@ -20,13 +26,15 @@ class PortalFTP:
 
         self.blocksize = blocksize
 
-        # A dictionary to store connections keyed by hostname
-        self.connections = {}
+        # FTP sessions are not thread-safe, so each thread keeps its own
+        # dictionary of connections keyed by hostname.
+        self._local = threading.local()
 
-    def download_file(self, url, local_path):
+    def download_file(self, url, local_path, md5=None):
         """
         Given a remote FTP file's URL, download it and save it to the specified
-        local path.
+        local path. If an md5 hash object is provided, it is updated with the
+        complete contents of the local file.
         """
         self.logger.debug("In download_file. URL: %s", url)
 
@@ -42,71 +50,79 @@ class PortalFTP:
         if os.path.exists(local_path):
             current_byte = os.path.getsize(local_path)
 
+            # The data already present can't be hashed as it's downloaded
+            if md5 is not None:
+                update_from_file(md5, local_path)
+
             if current_byte < remote_file_size:
                 self.logger.warning("The local file is smaller than the remote one.")
-                self._handle_chunked_download(url, local_path, current_byte, remote_file_size)
+                self._handle_chunked_download(url, local_path, current_byte,
+                                              remote_file_size, md5)
             elif current_byte > remote_file_size:
                 self.logger.warning("The local file is LARGER than the remote one! Skipping.")
             else:
                 # sizes must be equal
                 self.logger.info("File already present. Skipping.")
         else:
-            self._handle_chunked_download(url, local_path, current_byte, remote_file_size)
+            self._handle_chunked_download(url, local_path, current_byte,
+                                          remote_file_size, md5)
 
-    def _handle_chunked_download(self, url, file_name, current_byte, file_size):
+    def _handle_chunked_download(self, url, file_name, current_byte, file_size, md5):
         self.logger.debug("In _handle_chunked_download: %s", url)
 
         res = self._get_url_obj(url)
 
         blocksize = self.blocksize
 
-        with open(file_name, 'ab') as file:
+        with open(file_name, 'ab', buffering=WRITE_BUFFER_SIZE) as file:
 
-            print(
+            status.output(
                 "Downloading file via FTP: {0} | total bytes = {1}"
                     .format(file_name, file_size)
             )
 
             if blocksize > file_size:
-                _generate_status_message("block size greater than " + \
+                status.generate_status_message("block size greater than " + \
                     "total file size. Pulling in entire file.")
 
-            self._get_buffer(res, current_byte, file_size, file)
+            self._get_buffer(res, current_byte, file_size, file, md5)
 
 
     def _get_ftp_connection(self, host):
         self.logger.debug("In _get_ftp_connection. Host: %s", host)
 
-        if host not in self.connections:
+        connections = getattr(self._local, 'connections', None)
+
+        if connections is None:
+            connections = {}
+            self._local.connections = connections
+
+        if host not in connections:
             ftp = FTP(host)
             ftp.login()
-            self.connections[host] = ftp
+            connections[host] = ftp
 
-        conn = self.connections[host]
+        conn = connections[host]
 
         return conn
 
-    # Get a network object of the file that can be iterated over.
+    # Get a network object of the file that can be iterated over. There's
+    # no separate listing to check that the file exists: the SIZE command
+    # issued by _get_file_size() already fails if it doesn't, as does RETR.
     # Arguments:
     # url = path to location of the file on the web
-    # current_byte = The byte position to retrieve data from
     def _get_url_obj(self, url):
         self.logger.debug("In _get_url_obj: %s", url)
 
         parsed = self._parse_ftp_url(url)
         ftp = self._get_ftp_connection(parsed['host'])
 
-        # Make sure there's something there
-        if list(ftp.nlst(parsed['file_path'])):
-            file_str = "RETR {0}".format(parsed['file_path'])
+        file_str = "RETR {0}".format(parsed['file_path'])
 
-            def get_data(callback, blocksize, start_pos):
-                ftp.retrbinary(file_str, callback, blocksize=blocksize, rest=start_pos)
+        def get_data(callback, blocksize, start_pos):
+            ftp.retrbinary(file_str, callback, blocksize=blocksize, rest=start_pos)
 
-            return get_data
-
-        # If made it here, no network object established
-        return "error"
+        return get_data
 
     # Function to retrieve the file size.
     # Arguments:
@@ -126,25 +142,18 @@ class PortalFTP:
     # Function to retrieve a particular set of bytes from the file.
     # Arguments:
     # res = network object created by get_url_obj()
-    def _get_buffer(self, res, start_pos, max_range, file):
+    # md5 = optional hash object to update with the data as it arrives
+    def _get_buffer(self, res, start_pos, max_range, file, md5=None):
         self.logger.debug("In _get_buffer.")
 
-        current_byte = start_pos
-
         # The Python ftplib requires transfer to pass to a callback function,
-        # using this to break up the download into pieces. Unfortunately this
-        # function by default accepts just the byte-block being pulled by
-        # .retrbinary() so we need a nonlocal variable to help with printing
-        # out the progress.
-        def callback(data):
-            nonlocal current_byte
+        # which receives each byte-block pulled by .retrbinary(). The writer
+        # takes care of writing it out, hashing it and reporting progress.
+        writer = TeeWriter(file, md5, status.Progress(max_range, file.name), start_pos)
 
-            file.write(data)
+        res(writer.write, self.blocksize, start_pos)
 
-            current_byte += len(data)
-            _generate_status_message("{0}  [{1:.2f}%]".format(current_byte, current_byte * 100 / max_range))
-
-        res(callback, self.blocksize, start_pos)
+        writer.finish()
 
         return None
 
@@ -156,12 +165,3 @@ class PortalFTP:
         file_path = url.split(host)[1]
 
         return {'dest': dest, 'host': host, 'file_path': file_path}
-
-# Function to output a status message to the user.
-# Argument:
-# message = the string to temporarily output to the user
-def _generate_status_message(message):
-    status = message
-    # backspace everything
-    status = status + chr(8) * (len(status) + 1)
-    print("\r{0}".format(status), end="")
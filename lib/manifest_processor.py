@@ -6,18 +6,24 @@ import hashlib
 import logging
 import os
 import shutil
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import aspera
+import status
+from transfer import BackgroundHasher, discard_partial, in_ranged_download
+from transfer import remove_tracking, update_from_file
 
 from portal_http import PortalHTTP
-from s3 import S3
+from s3 import S3, is_ec2_instance
 from ftp import PortalFTP
 
-from boto.utils import get_instance_metadata
-
 class ManifestProcessor(object):
 
     def __init__(self, username=None, password=None, google_client_secrets=None,
-                 google_project_id=None, blocksize=100000):
+                 google_project_id=None, blocksize=100000, workers=4,
+                 connections=4):
         """
         Constructor for the ManifestProcessor class.
         """
@@ -25,17 +31,36 @@ class ManifestProcessor(object):
 
         self.logger.addHandler(logging.NullHandler())
 
+        # Ranges of large HTTP/S3 files are fetched by pools shared by all
+        # the files being downloaded concurrently.
+        max_connections = workers * connections
+
         # Create the HTTP client
-        self.http_client = PortalHTTP(blocksize=blocksize)
+        self.http_client = PortalHTTP(blocksize=blocksize, connections=connections,
+                                      max_connections=max_connections)
 
         # Create the FTP client
         self.ftp_client = PortalFTP(blocksize=blocksize)
 
         # Create the AWS S3 client
-        self.aws_s3 = S3(blocksize=blocksize)
+        self.aws_s3 = S3(blocksize=blocksize, connections=connections,
+                         max_connections=max_connections)
 
         self.blocksize = blocksize
 
+        # The number of files to download concurrently
+        self.workers = workers
+
+        # Set when the download of a manifest is interrupted, so that the
+        # files in progress don't carry on with their other URLs.
+        self.stopping = threading.Event()
+
+        # A lock for each local file, so that entries sharing a file aren't
+        # downloaded into it at the same time.
+        self.target_locks = {}
+
+        self.target_locks_lock = threading.Lock()
+
         self.username = username
 
         self.password = password
@@ -49,7 +74,7 @@ class ManifestProcessor(object):
             from gcp import GCP
             self.gcp_client = GCP(google_project_id, google_client_secrets)
 
-    def _get_fasp_obj(self, url, file_name):
+    def _get_fasp_obj(self, url, file_name, md5=None):
         self.logger.debug("In _get_fasp_obj: %s", url)
 
         if url.startswith('fasp://'):
@@ -60,8 +85,10 @@ class ManifestProcessor(object):
         server = url.split('/')[0]
         self.logger.debug("Aspera server: %s", server)
 
-        remote_path = url
-        remote_path = remote_path.lstrip(server)
+        # Everything after the server, starting with the /. Note that
+        # str.lstrip(server) would strip any of the characters in the
+        # server name from the start of the path as well.
+        remote_path = url[len(server):]
         self.logger.debug("Remote path: %s", remote_path)
 
         result = None
@@ -73,6 +100,8 @@ class ManifestProcessor(object):
             if not success:
                 self.logger.error("Aspera transfer failed.")
                 result = "error"
+            elif md5 is not None:
+                update_from_file(md5, file_name)
         except Exception as e:
             self.logger.error(e)
             result = "error"
@@ -81,7 +110,7 @@ class ManifestProcessor(object):
 
         return result
 
-    def _get_gcp_obj(self, url, file_name):
+    def _get_gcp_obj(self, url, file_name, md5=None):
         self.logger.debug("In _get_gcp_obj: %s", url)
 
         if not url.startswith('gs://'):
@@ -92,6 +121,9 @@ class ManifestProcessor(object):
 
         try:
             self.gcp_client.download_file(url, file_name)
+
+            if md5 is not None:
+                update_from_file(md5, file_name)
         except Exception as e:
             self.logger.error(e)
             result = "error"
@@ -100,7 +132,7 @@ class ManifestProcessor(object):
 
         return result
 
-    def _get_ftp_obj(self, url, file_name):
+    def _get_ftp_obj(self, url, file_name, md5=None):
         self.logger.debug("In _get_ftp_obj: %s", url)
 
         if not url.startswith('ftp://'):
@@ -110,7 +142,7 @@ class ManifestProcessor(object):
         result = None
 
         try:
-            self.ftp_client.download_file(url, file_name)
+            self.ftp_client.download_file(url, file_name, md5)
         except Exception as e:
             self.logger.error(e)
             result = "error"
@@ -119,7 +151,7 @@ class ManifestProcessor(object):
 
         return result
 
-    def _get_http_obj(self, url, file_name):
+    def _get_http_obj(self, url, file_name, md5=None):
         self.logger.debug("In _get_http_obj: %s", url)
 
         if not (url.startswith('http://') or url.startswith('https://')):
@@ -129,7 +161,7 @@ class ManifestProcessor(object):
         result = None
 
         try:
-            self.http_client.download_file(url, file_name)
+            self.http_client.download_file(url, file_name, md5)
         except Exception as e:
             self.logger.error(e)
             result = "error"
@@ -138,7 +170,7 @@ class ManifestProcessor(object):
 
         return result
 
-    def _get_s3_obj(self, url, file_name):
+    def _get_s3_obj(self, url, file_name, md5=None):
         self.logger.debug("In _get_s3_obj: %s", url)
 
         if not url.startswith('s3://'):
@@ -148,7 +180,7 @@ class ManifestProcessor(object):
         result = None
 
         try:
-            self.aws_s3.download_file(url, file_name)
+            self.aws_s3.download_file(url, file_name, md5)
         except Exception as e:
             self.logger.error(e)
             result = "error"
@@ -170,7 +202,9 @@ class ManifestProcessor(object):
 
     def download_manifest(self, manifest, destination, priorities):
         """
-        Downloads each URL from the manifest.
+        Downloads each URL from the manifest. Files are downloaded
+        concurrently by a pool of worker threads. Returns a Counter of the
+        number of files with each result code.
         Arguments:
         manifest = manifest list
         destination = the destination directory to save downloaded files
@@ -178,139 +212,236 @@ class ManifestProcessor(object):
         """
         self.logger.debug("In download_manifest.")
 
-        # Build a list of elements to indicate how many and why the files failed
+        # Count how many files succeeded, and how many failed and why
+        # 0 = success
         # 1 = no valid URL in manifest
         # 2 = URL exists, but not accessible at the location specified
         # 3 = MD5 check failed for file (file is corrupted or the wrong MD5 is attached to the file)
-        failed_files = []
+        results = Counter()
 
-        # iterate over the manifest data structure, one ID/file at a time
-        for mfile in manifest:
+        # Work out the priorities once for the whole manifest
+        endpoints = self._get_endpoint_priorities(priorities)
 
-            url_list = self._get_prioritized_endpoint(mfile['urls'], priorities)
+        self.stopping.clear()
+        self.http_client.ranged.reset()
 
-            # Handle private data or simply nodes that are not correct and lack
-            # endpoint data
-            if not url_list:
-                print("No valid URL found in the manifest for file ID {0}".format(mfile['id']))
-                failed_files.append(1)
-                continue
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [
+                executor.submit(self._download_one, mfile, destination, endpoints)
+                for mfile in manifest
+            ]
+
+            try:
+                for future in as_completed(futures):
+                    results[future.result()] += 1
+            except BaseException:
+                # Leaving the with block waits for every file submitted, so
+                # on Ctrl-C (or any other error) the files not yet started
+                # are cancelled and those in progress are told to stop.
+                for future in futures:
+                    future.cancel()
+
+                self.stopping.set()
+                self.http_client.ranged.cancel()
+
+                raise
+
+        # Make sure all the progress messages are out before returning
+        status.flush()
 
-            url_file_element = url_list[0].split('/')[-1]
-            file_name = os.path.join(destination, url_file_element)
+        return results
 
-            # Only need to download if the file is not present
-            if os.path.exists(file_name):
-                self.logger.info("File %s already exists. Skipping.", file_name)
-                failed_files.append(0)
+    def _download_one(self, mfile, destination, priorities):
+        """
+        Downloads a single file described by a manifest entry, returning
+        0 on success or one of the failure codes used by download_manifest().
+        Arguments:
+        mfile = the manifest entry for the file
+        destination = the destination directory to save the downloaded file
+        priorities = the list of protocols, in descending priority
+        """
+        self.logger.debug("In _download_one: %s", mfile['id'])
+
+        url_list = self._get_prioritized_endpoint(mfile['urls'], priorities)
+
+        # Handle private data or simply nodes that are not correct and lack
+        # endpoint data
+        if not url_list:
+            status.output("No valid URL found in the manifest for file ID {0}".format(mfile['id']))
+            return 1
+
+        url_file_element = url_list[0].split('/')[-1]
+        file_name = os.path.join(destination, url_file_element)
+
+        # Whichever entry for the same file comes second waits, and then
+        # finds the file already present, just as if they ran one at a time.
+        with self._get_target_lock(file_name):
+            return self._download_to(mfile, url_list, file_name)
+
+    def _download_to(self, mfile, url_list, file_name):
+        """
+        Downloads the file described by a manifest entry to the given local
+        path, returning 0 on success or one of the failure codes used by
+        download_manifest().
+        Arguments:
+        mfile = the manifest entry for the file
+        url_list = the URLs of the file, in descending priority
+        file_name = the local path to save the file to
+        """
+        self.logger.debug("In _download_to: %s", file_name)
+
+        # Only need to download if the file is not present
+        if os.path.exists(file_name):
+            self.logger.info("File %s already exists. Skipping.", file_name)
+            return 0
+
+        self.logger.debug("File not present. Proceeding.")
+
+        tmp_file_name = "{0}.partial".format(file_name)
+
+        res, endpoint = ("" for i in range(2))
+        endpoints = []
+
+        for url in url_list:
+            # The result doesn't matter once the manifest was interrupted
+            if self.stopping.is_set():
+                return 2
+
+            endpoint = url.split(':')[0].upper()
+            endpoints.append(endpoint)
+
+            if endpoint == "HTTPS":
+                endpoint = "HTTP"
+
+            # A ranged download left unfinished by an earlier attempt can't
+            # be resumed by the other clients, which would mistake the file
+            # for a complete one.
+            if endpoint != "HTTP" and in_ranged_download(tmp_file_name):
+                self.logger.info("Discarding unfinished ranged download of %s.",
+                                 tmp_file_name)
+                discard_partial(tmp_file_name)
+
+            # The MD5 is computed on a separate thread as the data is
+            # downloaded. Each attempt starts a new one, since whatever a
+            # failed attempt left on disk is hashed again by the next.
+            md5 = None
+            if self.validation:
+                md5 = BackgroundHasher(hashlib.md5())
+
+            if endpoint == "FASP":
+                res = self._get_fasp_obj(url, tmp_file_name, md5)
+            elif endpoint == "GS":
+                res = self._get_gcp_obj(url, tmp_file_name, md5)
+            elif endpoint == "HTTP":
+                res = self._get_http_obj(url, tmp_file_name, md5)
+            elif endpoint == "FTP":
+                res = self._get_ftp_obj(url, tmp_file_name, md5)
+            elif endpoint == "S3":
+                res = self._get_s3_obj(url, tmp_file_name, md5)
             else:
-                self.logger.debug("File not present. Proceeding.")
-
-                tmp_file_name = "{0}.partial".format(file_name)
-
-                res, endpoint = ("" for i in range(2))
-                endpoints = []
-
-                for url in url_list:
-                    endpoint = url.split(':')[0].upper()
-                    endpoints.append(endpoint)
-
-                    if endpoint == "FASP":
-                        res = self._get_fasp_obj(url, tmp_file_name)
-                    elif endpoint == "GS":
-                        res = self._get_gcp_obj(url, tmp_file_name)
-                    elif endpoint == "HTTP":
-                        res = self._get_http_obj(url, tmp_file_name)
-                    elif endpoint == "FTP":
-                        res = self._get_ftp_obj(url, tmp_file_name)
-                    elif endpoint == "S3":
-                        res = self._get_s3_obj(url, tmp_file_name)
-                    else:
-                        res = "error"
-
-                    # If we get an error, continue to the next url in the list
-                    if res == "error":
-                        continue
-
-                # If all attempts resulted in error, move on to next file
-                if res == "error":
-                    print("Skipping file ID {0} as none of the URLs {1} succeeded."
-                          .format(mfile['id'], endpoints))
-                    failed_files.append(2)
-                    continue
-
-                if self.validation:
-                    # Now that the download is complete, verify the checksum,
-                    # and then establish the final file
-                    if self._checksum_matches(tmp_file_name, mfile['md5']):
-                        self.logger.debug("Renaming %s to %s", tmp_file_name, file_name)
-                        shutil.move(tmp_file_name, file_name)
-                        failed_files.append(0)
-                    else:
-                        print("\r")
-                        msg = "MD5 check failed for the file ID {0}. " + \
-                              "Data may be corrupted."
-                        print(msg.format(mfile['id']))
-                        failed_files.append(3)
-                else:
-                    self.logger.debug(
-                        "Skipping checksumming. Renaming %s to %s", tmp_file_name, file_name
-                    )
-                    shutil.move(tmp_file_name, file_name)
-                    failed_files.append(0)
-
-        return failed_files
+                res = "error"
 
-    # Function to get the URL for the prioritized endpoint that the user requests.
-    # Note that priorities can be a list of ordered priorities.
+            # Don't leave the hashing thread behind, whatever the outcome
+            if md5 is not None:
+                md5.close()
+
+            # If we get an error, continue to the next url in the list
+            if res == "error":
+                continue
+
+            break
+
+        # If all attempts resulted in error, move on to next file
+        if res == "error":
+            status.output("Skipping file ID {0} as none of the URLs {1} succeeded."
+                          .format(mfile['id'], endpoints))
+            return 2
+
+        if self.validation:
+            # Now that the download is complete, verify the checksum,
+            # and then establish the final file. This failing is largely
+            # telling that the MD5 in the manifest is not correct.
+            valid = md5.hexdigest() == mfile['md5']
+            self.logger.debug("Checksum valid? %s", str(valid))
+
+            if valid:
+                self.logger.debug("Renaming %s to %s", tmp_file_name, file_name)
+                shutil.move(tmp_file_name, file_name)
+
+                # Whichever client completed the file, the files tracking
+                # earlier attempts to download it are no longer needed.
+                remove_tracking(tmp_file_name)
+                return 0
+
+            status.output("\r")
+            msg = "MD5 check failed for the file ID {0}. " + \
+                  "Data may be corrupted."
+            status.output(msg.format(mfile['id']))
+            return 3
+
+        self.logger.debug(
+            "Skipping checksumming. Renaming %s to %s", tmp_file_name, file_name
+        )
+        shutil.move(tmp_file_name, file_name)
+        remove_tracking(tmp_file_name)
+
+        return 0
+
+    # Function to get the lock guarding a local file, creating it the first
+    # time the file is seen.
+    # Arguments:
+    # file_name = the local path of the file
+    def _get_target_lock(self, file_name):
+        with self.target_locks_lock:
+            return self.target_locks.setdefault(os.path.abspath(file_name),
+                                                threading.Lock())
+
+    # Function to determine the list of protocols to use, in descending
+    # priority.
     # Arguments:
-    # manifest_urls = the CSV set of endpoint URLs
     # priorities = priorities declared when calling client.py
-    def _get_prioritized_endpoint(self, manifest_urls, priorities):
-        self.logger.debug("In _get_prioritized_endpoint.")
-        url_list = []
+    def _get_endpoint_priorities(self, priorities):
+        self.logger.debug("In _get_endpoint_priorities.")
 
-        urls = manifest_urls.split(',')
         eps = priorities.split(',')
 
         # If the user didn't provide a set of priorities, then prioritize based on
         # whether on an EC2 instance.
         if eps[0] == "":
 
-            md = get_instance_metadata(timeout=0.5, num_retries=1)
-
-            if md:
+            if is_ec2_instance(timeout=0.5):
                 eps = ['S3', 'HTTP', 'FTP']
             else:
-                # If none provided, use this order
-                eps = ['HTTP', 'FTP', 'S3']
+                # If none provided, use this order. FTP is only a fallback,
+                # as its transfers use a single connection per file.
+                eps = ['HTTP', 'S3', 'FTP']
 
-        # Go through and build a list starting with the higher priorities first.
-        for ep in eps:
-            for url in urls:
-                if url.startswith(ep.lower()):
-                    url_list.append(url)
+        return [ep.lower() for ep in eps]
 
-        return url_list
-
-    # This function failing is largely telling that the data in OSDF for the
-    # particular file's MD5 is not correct.
+    # Function to get the URL for the prioritized endpoint that the user requests.
+    # Note that priorities can be a list of ordered priorities.
     # Arguments:
-    # file_path = location of the file just downloaded which requires an integrity check
-    # original_md5 = MD5 provided by OSDF data
-    def _checksum_matches(self, file_path, original_md5):
-        self.logger.debug("In checksum_matches. Checking %s.", file_path)
-        md5 = hashlib.md5()
+    # manifest_urls = the CSV set of endpoint URLs
+    # priorities = list of (lowercase) protocols from _get_endpoint_priorities()
+    def _get_prioritized_endpoint(self, manifest_urls, priorities):
+        self.logger.debug("In _get_prioritized_endpoint.")
+
+        # Classify the URLs by protocol in a single pass. HTTPS URLs are
+        # handled by the HTTP protocol.
+        by_scheme = {}
+
+        for url in manifest_urls.split(','):
+            scheme = url.split('://', 1)[0].lower()
 
-        # Read the file in chunks and build a final MD5
-        with open(file_path, 'rb') as filehandle:
-            for chunk in iter(lambda: filehandle.read(4096), b""):
-                md5.update(chunk)
+            if scheme == 'https':
+                scheme = 'http'
 
-        valid = False
-        if md5.hexdigest() == original_md5:
-            valid = True
+            by_scheme.setdefault(scheme, []).append(url)
 
-        self.logger.debug("Checksum valid? %s", str(valid))
+        # Build a list starting with the higher priorities first.
+        url_list = []
+
+        for ep in priorities:
+            url_list.extend(by_scheme.get(ep, []))
 
-        return valid
+        return url_list
@@ -8,6 +8,7 @@ import logging
 import os
 import errno
 import sys
+from collections import Counter
 
 from manifest_processor import ManifestProcessor
 from convert_to_manifest import file_to_manifest
@@ -136,8 +137,8 @@ def parse_cli():
         required=False,
         default="",
         help='Optional comma-separated protocol priorities (descending). ' + \
-             'The valid protocols are "HTTP", "FTP", "FASP", "S3" and "GS" ' + \
-             '(and defaults to that order).'
+             'The valid protocols are "HTTP", "FTP", "FASP", "S3" and "GS". ' + \
+             'Defaults to "HTTP,S3,FTP" ("S3,HTTP,FTP" on Amazon EC2).'
     )
 
     parser.add_argument(
@@ -159,6 +160,24 @@ def parse_cli():
              'failures. Defaults to 0.'
     )
 
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        required=False,
+        default=4,
+        help='Optional number of files to download concurrently. ' + \
+             'Defaults to 4.'
+    )
+
+    parser.add_argument(
+        '-c', '--connections',
+        type=int,
+        required=False,
+        default=4,
+        help='Optional number of connections used to download each large ' + \
+             'HTTP or S3 file in parallel byte ranges. Defaults to 4.'
+    )
+
     parser.add_argument(
         '--debug',
         action='store_true',
@@ -167,6 +186,12 @@ def parse_cli():
 
     args = parser.parse_args()
 
+    for option, value in (('workers', args.workers), ('connections', args.connections)):
+        if value < 1:
+            sys.stderr.write("Error: Invalid number of {0}. ".format(option) + \
+                "The {0} option must be at least 1.\n".format(option))
+            sys.exit(1)
+
     # This is later populated if the user specifies the --user argument.
     args.password = None
 
@@ -228,7 +253,7 @@ def main():
     if args.debug:
         set_logging()
 
-    default_endpoint_priority = ['HTTP', 'FTP', 'S3']
+    default_endpoint_priority = ['HTTP', 'S3', 'FTP']
     valid_endpoints = ['HTTP', 'FTP', 'S3', 'FASP', 'GS']
 
     if args.endpoint_priority != "":
@@ -261,12 +286,14 @@ def main():
 
     keep_trying = True
     attempts = 0
-    result = []
+    result = Counter()
 
     logger.debug("Creating ManifestProcessor.")
     mp = ManifestProcessor(username, password,
                            google_client_secrets=client_secrets,
-                           google_project_id=project_id)
+                           google_project_id=project_id,
+                           workers=args.workers,
+                           connections=args.connections)
 
     # Turn off MD5 checksumming if specified by the user
     if args.disable_validation:
@@ -291,15 +318,17 @@ def main():
             args.endpoint_priority
         )
 
-        if len(result) == 0 or result.count(0) == len(result):
+        file_count = sum(result.values())
+
+        if result[0] == file_count:
             # No failures found
             keep_trying = False
         else:
             retry_results_msg(
-                len(result),
-                result.count(1),
-                result.count(2),
-                result.count(3)
+                file_count,
+                result[1],
+                result[2],
+                result[3]
             )
 
             if attempts == args.retries:
@@ -309,7 +338,7 @@ def main():
                 print("Initiating download attempt number {}...\n".format(attempts))
 
                 # Never going to get anywhere if no URLs are present
-                if result.count(1) == len(result):
+                if result[1] == file_count:
                     keep_trying = False
 
 if __name__ == '__main__':
@@ -1,11 +1,22 @@
 import os
 import logging
+import shutil
+from functools import partial
 from os import path
-import urllib.request
 import sys
+import urllib.parse
+import urllib.request
+
+import urllib3
+from urllib3.exceptions import ProxySchemeUnknown
+from urllib3.util.retry import Retry
+
+import status
+from transfer import WRITE_BUFFER_SIZE, RangedDownloader, TeeWriter, update_from_file
+from transfer import discard_partial, read_meta, remove_meta, write_meta
 
 class PortalHTTP(object):
-    def __init__(self, blocksize=100000):
+    def __init__(self, blocksize=100000, connections=4, max_connections=None):
         """
         Constructor for the PortalHTTP class.
         """
@@ -15,106 +26,289 @@ class PortalHTTP(object):
 
         self.blocksize = blocksize
 
-    def download_file(self, url, local_path):
+        if max_connections is None:
+            max_connections = connections
+
+        # Connections are kept alive and reused across requests and files,
+        # sparing a TCP (and TLS) handshake for each. The pool manager is
+        # thread-safe, so it's shared by all the downloads.
+        pool_options = {
+            'num_pools': 32,
+            'maxsize': max(max_connections, 10),
+            'retries': Retry(total=3, backoff_factor=0.3)
+        }
+
+        self.pool = urllib3.PoolManager(**pool_options)
+
+        # Unlike urllib, urllib3 doesn't look for proxies in the environment
+        # (http_proxy, https_proxy and no_proxy), so a pool is set up here
+        # for each proxy found there.
+        self.proxy_pools = {}
+
+        for scheme, proxy in urllib.request.getproxies().items():
+            if scheme not in ('http', 'https'):
+                continue
+
+            try:
+                self.proxy_pools[scheme] = urllib3.ProxyManager(proxy, **pool_options)
+            except ProxySchemeUnknown:
+                self.logger.warning("Unsupported {0} proxy {1}. Ignoring it."
+                                    .format(scheme, proxy))
+
+        # Used to download large files as concurrently fetched byte ranges
+        self.ranged = RangedDownloader(connections=connections,
+                                       max_connections=max_connections)
+
+    def download_file(self, url, local_path, md5=None):
+        """
+        Given a remote HTTP file's URL, download it and save it to the
+        specified local path. If an md5 hash object is provided, it is
+        updated with the complete contents of the local file.
+        """
         self.logger.debug("In download_file. URL: {}".format(url))
 
         # If we only have part of a file, get the new start position
         current_byte = 0
 
-        # Need to pull the size without the potential bytes buffer
-        remote_file_size = self._get_file_size(url)
+        # A single HEAD request tells us all we need to know about the file
+        file_info = self._get_file_info(url)
+        remote_file_size = file_info['size']
 
+        meta = {
+            'url': url,
+            'etag': file_info['etag'],
+            'last_modified': file_info['last_modified'],
+            'content_length': remote_file_size
+        }
+
+        # Data left behind by an earlier attempt is only worth keeping if the
+        # remote file hasn't changed since. Partial files without recorded
+        # details (left by another endpoint) are trusted as before.
         if os.path.exists(local_path):
+            previous_meta = read_meta(local_path)
+
+            if previous_meta is not None and previous_meta != meta:
+                self.logger.warning("The remote file changed since the download began. " + \
+                                    "Starting over.")
+                discard_partial(local_path)
+
+        write_meta(local_path, meta)
+
+        if self.ranged.in_progress(local_path):
+            self.logger.info("Resuming ranged download.")
+            self._handle_ranged_download(url, local_path, file_info, md5)
+        elif os.path.exists(local_path):
             current_byte = os.path.getsize(local_path)
 
             if current_byte < remote_file_size:
-                self.logger.warn("The local file is smaller than the remote one.")
-                self._handle_chunked_download(url, local_path, current_byte, remote_file_size)
-            elif current_byte > remote_file_size:
-                self.logger.warn("The local file is LARGER than the remote one! Skipping.")
+                self.logger.warning("The local file is smaller than the remote one.")
+                self._handle_chunked_download(url, local_path, current_byte,
+                                              file_info, md5)
             else:
-                # sizes must be equal
-                self.logger.info("File already present. Skipping.")
+                if current_byte > remote_file_size:
+                    self.logger.warning("The local file is LARGER than the remote one! Skipping.")
+                else:
+                    # sizes must be equal
+                    self.logger.info("File already present. Skipping.")
+
+                if md5 is not None:
+                    update_from_file(md5, local_path)
+        elif self.ranged.should_split(remote_file_size) and file_info['accepts_ranges']:
+            self._handle_ranged_download(url, local_path, file_info, md5)
         else:
-            self._handle_chunked_download(url, local_path, current_byte, remote_file_size)
+            self._handle_chunked_download(url, local_path, current_byte,
+                                          file_info, md5)
+
+        remove_meta(local_path)
+
+    def _handle_ranged_download(self, url, file_name, file_info, md5):
+        self.logger.debug("In _handle_ranged_download: {}".format(url))
+
+        file_size = file_info['size']
+
+        status.output(
+            "Downloading file via HTTP: {0} | total bytes = {1} | connections = {2}"
+                .format(file_name, file_size, self.ranged.connections)
+        )
 
-    def _handle_chunked_download(self, url, file_name, current_byte, file_size):
+        read_range = partial(self._read_range, url, file_info['validator'])
+
+        self.ranged.download(read_range, file_name, file_size)
+
+        # Ranges arrive out of order, so the file is hashed once complete
+        if md5 is not None:
+            update_from_file(md5, file_name)
+
+    def _handle_chunked_download(self, url, file_name, current_byte, file_info, md5):
         self.logger.debug("In _handle_chunked_download: {}".format(url))
 
-        res = self._get_url_obj(url, current_byte)
+        file_size = file_info['size']
 
-        blocksize = self.blocksize
+        if current_byte > 0 and not file_info['accepts_ranges']:
+            self.logger.warning("Server doesn't support resuming downloads. Starting over.")
+            current_byte = 0
 
-        with open(file_name, 'ab') as file:
+        res = self._get_url_obj(url, current_byte, file_info['validator'])
 
-            print(
-                "Downloading file via HTTP: {0} | total bytes = {1}"
-                    .format(file_name, file_size)
-            )
+        # If-Range makes the server send the whole file if it changed since
+        # the download began.
+        if res == "error":
+            raise Exception("Unable to retrieve {}".format(url))
 
-            while True:
-                if blocksize > file_size:
-                    self._generate_status_message("block size greater than " + \
-                        "total file size. Pulling in entire file.")
+        if current_byte > 0 and res.status == 200:
+            self.logger.warning("The remote file changed since the download began. " + \
+                                "Starting over.")
+            current_byte = 0
 
-                buffer = self._get_buffer(res)
+        mode = 'ab'
+        if current_byte == 0:
+            mode = 'wb'
+        elif md5 is not None:
+            # The data already present can't be hashed as it's downloaded
+            update_from_file(md5, file_name)
 
-                if not buffer: # note that only HTTP/S3 make it beyond this point
-                    break
+        with open(file_name, mode, buffering=WRITE_BUFFER_SIZE) as file:
 
-                file.write(buffer)
+            status.output(
+                "Downloading file via HTTP: {0} | total bytes = {1}"
+                    .format(file_name, file_size)
+            )
 
-                current_byte += len(buffer)
+            if self.blocksize > file_size:
+                status.generate_status_message("block size greater than " + \
+                    "total file size. Pulling in entire file.")
 
-                msg = "{0}  [{1:.2f}%]".format(
-                    current_byte,
-                    current_byte * 100 / file_size
-                )
+            # The writer hashes the data and reports progress as
+            # copyfileobj() moves the response into the file.
+            writer = TeeWriter(file, md5, status.Progress(file_size, file_name), current_byte)
 
-                self._generate_status_message(msg)
+            try:
+                shutil.copyfileobj(res, writer, self.blocksize)
+            finally:
+                # Return the connection to the pool for the next request
+                res.release_conn()
+
+            writer.finish()
 
     # Get a network object of the file that can be iterated over.
     # Arguments:
     # url = path to location of the file on the web
     # current_byte = The byte position to retrieve data from
-    def _get_url_obj(self, url, current_byte):
+    # validator = ETag or Last-Modified value the data already present was
+    #             downloaded with, if any
+    def _get_url_obj(self, url, current_byte, validator=None):
         self.logger.debug("In _get_url_obj: {}".format(url))
 
         http_header = {}
-        http_header['Range'] = 'bytes={0}-'.format(current_byte)
+
+        if current_byte > 0:
+            http_header['Range'] = 'bytes={0}-'.format(current_byte)
+
+            if validator is not None:
+                http_header['If-Range'] = validator
 
         res = ""
 
+        # The file is saved exactly as served. Servers label some files
+        # (.gz ones in particular) with a Content-Encoding they were never
+        # asked for, and urllib3 would otherwise decompress them.
         try:
-            req = urllib.request.Request(url, headers=http_header)
-            res = urllib.request.urlopen(req)
-        except:
+            res = self._get_pool(url).request('GET', url, headers=http_header,
+                                              preload_content=False,
+                                              decode_content=False)
+        except Exception:
             res = ""
 
-        if res:
+        if res and res.status in (200, 206):
             return res
 
+        if res:
+            res.release_conn()
+
         # If made it here, no network object established
         return "error"
 
-    # Function to retrieve the file size.
+    # Generator yielding the data in a byte range of the file.
     # Arguments:
     # url = path to location of file on the web
-    def _get_file_size(self, url):
-        self.logger.debug("In _get_file_size.")
-        return int(urllib.request.urlopen(url).info()['Content-Length'])
+    # validator = ETag or Last-Modified value of the file being downloaded
+    # start = position of the first byte in the range
+    # end = position of the last byte in the range
+    def _read_range(self, url, validator, start, end):
+        http_header = {}
+        http_header['Range'] = 'bytes={0}-{1}'.format(start, end)
+
+        if validator is not None:
+            http_header['If-Range'] = validator
+
+        res = self._get_pool(url).request('GET', url, headers=http_header,
+                                          preload_content=False,
+                                          decode_content=False)
+
+        try:
+            if res.status != 206:
+                raise IOError("Server ignored the range request for {} ".format(url) + \
+                              "or the file changed.")
+
+            while True:
+                buffer = self._get_buffer(res)
+
+                if not buffer:
+                    break
+
+                yield buffer
+        finally:
+            # Return the connection to the pool for the next range
+            res.release_conn()
+
+    # Function to determine the pool of connections to use for a URL, going
+    # through a proxy unless no_proxy says otherwise.
+    # Arguments:
+    # url = path to location of file on the web
+    def _get_pool(self, url):
+        parts = urllib.parse.urlsplit(url)
+
+        proxy_pool = self.proxy_pools.get(parts.scheme)
+
+        if proxy_pool is None or urllib.request.proxy_bypass(parts.hostname or ''):
+            return self.pool
+
+        return proxy_pool
+
+    # Function to retrieve the file size, whether the server supports byte
+    # range requests, and the validators identifying the version of the file,
+    # with a single HEAD request.
+    # Arguments:
+    # url = path to location of file on the web
+    def _get_file_info(self, url):
+        self.logger.debug("In _get_file_info.")
+
+        res = self._get_pool(url).request('HEAD', url)
+
+        if res.status != 200:
+            raise IOError("HEAD request for {0} failed with status {1}."
+                          .format(url, res.status))
+
+        headers = res.headers
+
+        etag = headers.get('ETag')
+        last_modified = headers.get('Last-Modified')
+
+        # If-Range only accepts a strong ETag, or else a date
+        validator = last_modified
+        if etag is not None and not etag.startswith('W/'):
+            validator = etag
+
+        return {
+            'size': int(headers['Content-Length']),
+            'accepts_ranges': headers.get('Accept-Ranges', '') == 'bytes',
+            'etag': etag,
+            'last_modified': last_modified,
+            'validator': validator
+        }
 
     # Function to retrieve a particular set of bytes from the file.
     # Arguments:
     # res = network object created by get_url_obj()
     def _get_buffer(self, res):
         return res.read(self.blocksize)
-
-    # Function to output a status message to the user.
-    # Argument:
-    # message = the string to temporarily output to the user
-    def _generate_status_message(self, message):
-        status = message
-        # backspace everything
-        status = status + chr(8) * (len(status) + 1)
-        print("\r{0}".format(status), end="")
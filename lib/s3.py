@@ -1,13 +1,30 @@
+"""
+Handles the downloading of data from Amazon AWS S3 buckets.
+"""
+
 import os
 import logging
-from os import path
-import sys
+import shutil
+import urllib.request
+from functools import lru_cache
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore import UNSIGNED
+from botocore.config import Config
+
+import status
+from transfer import MIN_RANGED_SIZE, WRITE_BUFFER_SIZE, TeeWriter, update_from_file
+from transfer import discard_partial, read_meta, remove_meta, write_meta
 
-import boto
-from boto.utils import get_instance_metadata
+# The instance metadata service, only reachable from EC2 instances
+METADATA_URL = "http://169.254.169.254/latest/"
 
 class S3(object):
-    def __init__(self, blocksize=100000):
+    """
+    The S3 class provides for anonymous retrieval of data from Amazon S3.
+    """
+    def __init__(self, blocksize=100000, connections=4, max_connections=None):
         """
         Constructor for the S3 class.
         """
@@ -17,143 +34,181 @@ class S3(object):
 
         self.blocksize = blocksize
 
-        # Estalish an anonymous connection to S3 with boto
-        self.connection = boto.connect_s3(anon=True)
+        if max_connections is None:
+            max_connections = connections
 
-    def download_file(self, s3_remote_path, local_path):
+        # boto3 clients are thread-safe, so a single anonymous client, and its
+        # pool of connections, is shared by all the downloads.
+        self.client = boto3.client(
+            's3',
+            config=Config(
+                signature_version=UNSIGNED,
+                max_pool_connections=max(max_connections, 10)
+            )
+        )
+
+        # Large objects are downloaded by the transfer manager as parts
+        # fetched concurrently.
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MIN_RANGED_SIZE,
+            multipart_chunksize=MIN_RANGED_SIZE,
+            max_concurrency=max(connections, 1),
+            use_threads=connections > 1
+        )
+
+    def download_file(self, s3_remote_path, local_path, md5=None):
+        """
+        Given a remote S3 object's URL, starting with s3://, download it and
+        save it to the specified local path. If an md5 hash object is
+        provided, it is updated with the complete contents of the local file.
+        """
         self.logger.debug("In download_file.")
 
         if not s3_remote_path.startswith('s3://'):
             raise Exception("Invalid Amazon S3 path. Must start with s3://")
 
+        bucket_name, key = self._parse_s3_url(s3_remote_path)
+
         # If we only have part of a file, get the new start position
         current_byte = 0
 
-        # Need to pull the size without the potential bytes buffer
-        remote_file_size = self._get_file_size(s3_remote_path)
+        head = self.client.head_object(Bucket=bucket_name, Key=key)
+
+        remote_file_size = head['ContentLength']
         self.logger.debug("Remote file size: {}".format(remote_file_size))
 
+        meta = {
+            'url': s3_remote_path,
+            'etag': head['ETag'],
+            'content_length': remote_file_size
+        }
+
+        # Data left behind by an earlier attempt is only worth keeping if the
+        # object hasn't changed since. Partial files without recorded details
+        # (left by another endpoint) are trusted as before.
+        if os.path.exists(local_path):
+            previous_meta = read_meta(local_path)
+
+            if previous_meta is not None and previous_meta != meta:
+                self.logger.warning("The S3 object changed since the download began. " + \
+                                    "Starting over.")
+                discard_partial(local_path)
+
+        write_meta(local_path, meta)
+
         if os.path.exists(local_path):
             current_byte = os.path.getsize(local_path)
 
             if current_byte < remote_file_size:
-                self.logger.warn("The local file is smaller than the remote one.")
-                self._handle_chunked_download(s3_remote_path, local_path, current_byte, remote_file_size)
-            elif current_byte > remote_file_size:
-                self.logger.warn("The local file is LARGER than the remote one! Skipping.")
+                self.logger.warning("The local file is smaller than the remote one.")
+                self._handle_resumed_download(bucket_name, key, local_path, current_byte,
+                                              remote_file_size, head['ETag'], md5)
             else:
-                # sizes must be equal
-                self.logger.info("File already present. Skipping.")
+                if current_byte > remote_file_size:
+                    self.logger.warning("The local file is LARGER than the remote one! Skipping.")
+                else:
+                    # sizes must be equal
+                    self.logger.info("File already present. Skipping.")
+
+                if md5 is not None:
+                    update_from_file(md5, local_path)
         else:
-            self._handle_chunked_download(s3_remote_path, local_path, current_byte, remote_file_size)
+            self._handle_transfer(bucket_name, key, local_path, remote_file_size, md5)
 
+        remove_meta(local_path)
 
-    def _handle_chunked_download(self, url, tmp_file_name, current_byte, file_size):
-        self.logger.debug("In _handle_chunked_download.")
+    def _handle_transfer(self, bucket_name, key, tmp_file_name, file_size, md5):
+        self.logger.debug("In _handle_transfer.")
 
-        res = self._get_url_obj(url)
+        status.output(
+            "Downloading file from AWS S3: {0} | total bytes = {1}"
+                .format(tmp_file_name, file_size)
+        )
 
-        blocksize = self.blocksize
+        with open(tmp_file_name, 'wb', buffering=WRITE_BUFFER_SIZE) as filehandle:
+            # The writer can't seek, so the transfer manager hands it the
+            # parts in order, and the MD5 can be computed as they arrive.
+            progress = status.Progress(file_size, tmp_file_name)
+            writer = TeeWriter(filehandle, md5, progress)
 
-        with open(tmp_file_name, 'ab') as filehandle:
-            print(
-                "Downloading file from AWS S3: {0} | total bytes = {1}"
-                    .format(tmp_file_name, file_size)
+            self.client.download_fileobj(
+                bucket_name, key, writer, Config=self.transfer_config
             )
 
-            while True:
-                if blocksize > file_size:
-                    self._generate_status_message("block size greater than " + \
-                        "total file size, pulling in entire file.")
+            writer.finish()
 
-                buf = self._get_buffer(res, current_byte, file_size, filehandle)
+    def _handle_resumed_download(self, bucket_name, key, tmp_file_name, current_byte,
+                                 file_size, etag, md5):
+        self.logger.debug("In _handle_resumed_download.")
 
-                # Note: only HTTP and S3 make it beyond this point
-                if not buf:
-                    break
+        # Only the rest of the object is requested, and only if it's still
+        # the version that the data already present came from.
+        res = self.client.get_object(
+            Bucket=bucket_name,
+            Key=key,
+            Range='bytes={0}-'.format(current_byte),
+            IfMatch=etag
+        )
 
-                filehandle.write(buf)
+        # The data already present can't be hashed as it's downloaded
+        if md5 is not None:
+            update_from_file(md5, tmp_file_name)
 
-                current_byte += len(buf)
-
-                msg = "{0}  [{1:.2f}%]".format(
-                    current_byte,
-                    current_byte * 100 / file_size
-                )
-
-                self._generate_status_message(msg)
-
-    # Function to retrieve a particular set of bytes from the file.
-    # Arguments:
-    # res = network object created by get_url_obj()
-    # block_size = number of bytes to be considered a chunk to allow interrupts/resumes
-    # start_pos = position to start at
-    # max_range = maximum value to use for the range, same as the file's size
-    # file = file handle to write out to
-    def _get_buffer(self, res, start_pos, max_range, file):
-        if start_pos >= max_range:
-            return None # exit the while loop
-
-        headers = {}
-
-        # Offset by 1 since bytes are 0-based
-        range_end = start_pos + self.blocksize - 1
-
-        headers['Range'] = 'bytes={0}-'.format(start_pos)
-
-        if range_end <= max_range:
-            headers['Range'] += "{0}".format(range_end)
-
-        return res.get_contents_as_string(headers=headers)
-
-    # Get the key object from S3.
-    # Arguments:
-    # url = path to location of file on the web
-    def _s3_get_key(self, url):
-        self.logger.debug("In _s3_get_key.")
+        with open(tmp_file_name, 'ab', buffering=WRITE_BUFFER_SIZE) as filehandle:
+            status.output(
+                "Downloading file from AWS S3: {0} | total bytes = {1}"
+                    .format(tmp_file_name, file_size)
+            )
 
-        url = url.lstrip('s3://')
-        bucket_name = url.split('/', 1)[0]
-        key = url.split('/', 1)[1]
+            progress = status.Progress(file_size, tmp_file_name)
+            writer = TeeWriter(filehandle, md5, progress, current_byte)
 
-        self.logger.debug("Bucket name: {}".format(bucket_name))
-        bucket = self.connection.get_bucket(bucket_name)
+            shutil.copyfileobj(res['Body'], writer, self.blocksize)
 
-        return bucket.get_key(key)
+            writer.finish()
 
-    # Get a network object of the file that can be iterated over.
+    # Split an S3 URL into the bucket name and key.
     # Arguments:
     # url = path to location of file on Amazon S3
-    def _get_url_obj(self, url):
-        self.logger.debug("In _get_url_obj: {}".format(url))
-
-        res = self._s3_get_key(url)
+    def _parse_s3_url(self, url):
+        self.logger.debug("In _parse_s3_url.")
 
-        # Assume we errored...
-        return_value = "error"
+        # Strip the scheme. Note that str.lstrip() would strip any of the
+        # characters in 's3://' from the bucket name as well.
+        if url.startswith('s3://'):
+            url = url[5:]
 
-        if res:
-            # But, maybe we didn't...
-            return_value = res
+        bucket_name, key = url.split('/', 1)
 
-        return return_value
-
-    # Function to retrieve the file size.
-    # Arguments:
-    # url = path to location of file on the web
-    def _get_file_size(self, url):
-        self.logger.debug("In _get_file_size.")
-
-        key = self._s3_get_key(url)
-
-        return key.size
-
-    # Function to output a status message to the user.
-    # Argument:
-    # message = the string to temporarily output to the user
-    def _generate_status_message(self, message):
-        status = message
-        # backspace everything
-        status = status + chr(8) * (len(status) + 1)
-        print("\r{0}".format(status), end="")
+        self.logger.debug("Bucket name: {}".format(bucket_name))
 
+        return bucket_name, key
+
+@lru_cache(maxsize=None)
+def is_ec2_instance(timeout=0.5):
+    """
+    Determine if we are running on an Amazon EC2 instance by querying the
+    instance metadata service. The answer won't change, so it's cached.
+    """
+    # The metadata service must be contacted directly, never via a proxy
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+
+    probes = [
+        # IMDSv2 requires a session token...
+        urllib.request.Request(
+            METADATA_URL + "api/token",
+            method='PUT',
+            headers={'X-aws-ec2-metadata-token-ttl-seconds': '60'}
+        ),
+        # ...while IMDSv1 simply answers
+        urllib.request.Request(METADATA_URL + "meta-data/")
+    ]
+
+    for req in probes:
+        try:
+            with opener.open(req, timeout=timeout):
+                return True
+        except Exception:
+            pass
+
+    return False
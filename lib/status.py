@@ -0,0 +1,83 @@
+"""
+Serializes console output through a single printer thread so that messages
+from files being downloaded concurrently don't interleave.
+"""
+
+import os
+import queue
+import sys
+import threading
+import time
+
+# Progress is reported at most this often (in seconds) for each download.
+STATUS_INTERVAL = 0.1
+
+_MESSAGES = queue.Queue()
+
+def _printer():
+    """
+    Drain the message queue, writing each message to the console in the
+    order it was queued.
+    """
+    while True:
+        text = _MESSAGES.get()
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        _MESSAGES.task_done()
+
+_PRINTER = threading.Thread(target=_printer, name='status-printer', daemon=True)
+_PRINTER.start()
+
+def output(message):
+    """
+    Output a full line of text to the user.
+    """
+    _MESSAGES.put(message + "\n")
+
+def generate_status_message(message):
+    """
+    Output a status message to the user. The message is temporary and is
+    overwritten by the next one.
+    """
+    _MESSAGES.put("\r{0:<80}".format(message))
+
+class Progress(object):
+    """
+    The Progress class reports how much of a single download has completed.
+    Each update names the file, since the downloads of several files share
+    the status line. Updates arriving less than STATUS_INTERVAL seconds after
+    the last one are dropped, so they cost next to nothing on fast links.
+    """
+    def __init__(self, file_size, file_name):
+        """
+        Constructor for the Progress class.
+        """
+        self.file_size = file_size
+
+        self._prefix = os.path.basename(file_name) + ": "
+
+        # Computed once, so that a percentage is a single multiplication
+        self._pct_scale = 100.0 / file_size if file_size else 0.0
+
+        self._last_update = 0.0
+
+    def update(self, current_byte):
+        """
+        Report that current_byte bytes of the file have been downloaded.
+        Completion is always reported.
+        """
+        now = time.monotonic()
+
+        if now - self._last_update < STATUS_INTERVAL and current_byte < self.file_size:
+            return
+
+        self._last_update = now
+
+        generate_status_message(self._prefix + "%d  [%.2f%%]" %
+                                (current_byte, current_byte * self._pct_scale))
+
+def flush():
+    """
+    Block until every queued message has been output.
+    """
+    _MESSAGES.join()
@@ -0,0 +1,434 @@
+"""
+Helpers shared by the download clients for moving remote data into local
+files. Large files can be downloaded as a set of byte ranges that are fetched
+concurrently, each written directly to its own region of the local file.
+"""
+
+import hashlib
+import json
+import logging
+import mmap
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import status
+
+# Files smaller than this are not worth splitting into ranges.
+MIN_RANGED_SIZE = 8 * 1024 * 1024
+
+# The buffer size to use for the local files being downloaded to.
+WRITE_BUFFER_SIZE = 1024 * 1024
+
+# Downloaded data is dropped from the page cache in steps of this many bytes.
+FADVISE_INTERVAL = 8 * 1024 * 1024
+
+# The number of blocks that may be waiting to be hashed before the download
+# has to wait for the hashing to catch up.
+HASH_QUEUE_SIZE = 8
+
+class RangedDownloader(object):
+    """
+    The RangedDownloader class splits a download into byte ranges and
+    retrieves them in parallel. Completed ranges are recorded in an index file
+    next to the local file so that an interrupted download can be resumed
+    without fetching those ranges again.
+    """
+    def __init__(self, connections=4, max_connections=None):
+        """
+        Constructor for the RangedDownloader class. The connections argument
+        is the number of ranges a file is split into, while max_connections
+        bounds the number of ranges fetched at once across all the files
+        being downloaded (and defaults to connections).
+        """
+        self.logger = logging.getLogger(self.__module__ + '.' + self.__class__.__name__)
+
+        self.logger.addHandler(logging.NullHandler())
+
+        self.connections = connections
+
+        if max_connections is None:
+            max_connections = connections
+
+        # A single, long lived pool of threads fetches the ranges of every
+        # file, rather than spinning up a new pool for each download.
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(max_connections, 1),
+            thread_name_prefix='range'
+        )
+
+        # Set to make the downloads in progress stop fetching ranges
+        self.cancelled = threading.Event()
+
+    def should_split(self, file_size):
+        """
+        Determine if a file of the given size should be downloaded in ranges.
+        """
+        return self.connections > 1 and file_size >= MIN_RANGED_SIZE
+
+    def cancel(self):
+        """
+        Stop the ranged downloads in progress. Ranges not yet started are
+        skipped, and those being fetched stop at their next block.
+        """
+        self.cancelled.set()
+
+    def reset(self):
+        """
+        Allow ranged downloads again after cancel().
+        """
+        self.cancelled.clear()
+
+    def in_progress(self, local_path):
+        """
+        Determine if a ranged download of the local file was started, but
+        not completed.
+        """
+        return in_ranged_download(local_path)
+
+    def download(self, read_range, local_path, file_size):
+        """
+        Download a file of the given size to the local path. The read_range
+        argument is a function that accepts the first and last (inclusive)
+        byte positions of a range and yields the data in that range.
+        """
+        self.logger.debug("In download: %s", local_path)
+
+        index_path = _index_path(local_path)
+
+        # Round up so that the ranges cover the whole file
+        chunk = -(-file_size // self.connections)
+        ranges = [
+            (start, min(start + chunk, file_size) - 1)
+            for start in range(0, file_size, chunk)
+        ]
+
+        completed = self._load_index(index_path, file_size, chunk)
+
+        # Record the download before the file is allocated so that an
+        # interrupted download is always recognized as being in progress.
+        self._save_index(index_path, file_size, chunk, completed)
+
+        lock = threading.Lock()
+        current_byte = sum(ranges[i][1] - ranges[i][0] + 1 for i in completed)
+        progress = status.Progress(file_size, local_path)
+
+        fd = os.open(local_path, os.O_RDWR | os.O_CREAT, 0o644)
+
+        try:
+            os.ftruncate(fd, file_size)
+
+            def fetch(index):
+                nonlocal current_byte
+
+                start, end = ranges[index]
+                offset = start
+
+                # Local names for what's called on every block
+                pwrite = os.pwrite
+                update = progress.update
+                cancelled = self.cancelled.is_set
+
+                if cancelled():
+                    raise IOError("Download of {} cancelled.".format(local_path))
+
+                for buffer in read_range(start, end):
+                    if cancelled():
+                        raise IOError("Download of {} cancelled.".format(local_path))
+
+                    length = len(buffer)
+                    pwrite(fd, buffer, offset)
+                    offset += length
+
+                    with lock:
+                        current_byte += length
+                        update(current_byte)
+
+                if offset != end + 1:
+                    raise IOError("Range {0}-{1} ended early at byte {2}."
+                                  .format(start, end, offset))
+
+                with lock:
+                    completed.add(index)
+                    self._save_index(index_path, file_size, chunk, completed)
+
+            futures = [
+                self.executor.submit(fetch, index)
+                for index in range(len(ranges)) if index not in completed
+            ]
+
+            try:
+                for future in futures:
+                    future.result()
+            finally:
+                # The file must stay open until every range has stopped
+                # writing to it.
+                for future in futures:
+                    future.cancel()
+
+                wait(futures)
+
+            # Make sure the data is on disk before the file is moved into place
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        os.remove(index_path)
+
+    def _load_index(self, index_path, file_size, chunk):
+        """
+        Load the set of completed range indices. If the index was written
+        for a different file size or range layout, nothing can be reused.
+        """
+        if not os.path.exists(index_path):
+            return set()
+
+        try:
+            with open(index_path) as index_file:
+                index = json.load(index_file)
+        except ValueError:
+            self.logger.warning("Unable to parse %s. Starting over.", index_path)
+            return set()
+
+        if index.get('size') != file_size or index.get('chunk') != chunk:
+            self.logger.info("Range layout changed. Starting over.")
+            return set()
+
+        return set(index.get('completed', []))
+
+    def _save_index(self, index_path, file_size, chunk, completed):
+        """
+        Persist the set of completed range indices.
+        """
+        with open(index_path, 'w') as index_file:
+            json.dump({
+                'size': file_size,
+                'chunk': chunk,
+                'completed': sorted(completed)
+            }, index_file)
+
+class TeeWriter(object):
+    """
+    The TeeWriter class is a file-like object that writes data to a local
+    file while updating the MD5 and progress of the download, so that a
+    download can be handed to shutil.copyfileobj() or a callback in one go.
+    Data that has been written is dropped from the page cache as the download
+    progresses, since it won't be read again.
+    """
+    def __init__(self, file, md5=None, progress=None, current_byte=0):
+        """
+        Constructor for the TeeWriter class.
+        """
+        self.file = file
+
+        self.md5 = md5
+
+        self.progress = progress
+
+        self.current_byte = current_byte
+
+        # Look up what's called on every block once, rather than per block
+        self._write = file.write
+        self._hash = md5.update if md5 is not None else None
+        self._update = progress.update if progress is not None else None
+
+        self._fd = file.fileno()
+        self._advised_byte = current_byte
+        self._next_advice = current_byte + FADVISE_INTERVAL
+
+    def write(self, data):
+        """
+        Write a block of data to the file.
+        """
+        self._write(data)
+
+        if self._hash is not None:
+            self._hash(data)
+
+        length = len(data)
+        self.current_byte += length
+
+        if self._update is not None:
+            self._update(self.current_byte)
+
+        if self.current_byte >= self._next_advice:
+            self._drop_cache()
+
+        return length
+
+    def finish(self):
+        """
+        Flush the file to disk once the download is complete, so it can be
+        moved into place safely, and drop it from the page cache.
+        """
+        self.file.flush()
+        os.fsync(self._fd)
+
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(self._fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+    def _drop_cache(self):
+        """
+        Advise the kernel that the data written up to the previous advice
+        won't be needed again. Dirty pages can't be dropped, but the advice
+        starts their writeback, so the range advised lags one step behind.
+        There's nothing to advise on the first step of a fresh download, and
+        a length of 0 would advise the whole file.
+        """
+        if self._advised_byte > 0 and hasattr(os, 'posix_fadvise'):
+            self.file.flush()
+            os.posix_fadvise(self._fd, 0, self._advised_byte, os.POSIX_FADV_DONTNEED)
+
+        self._advised_byte = self.current_byte
+        self._next_advice = self.current_byte + FADVISE_INTERVAL
+
+class BackgroundHasher(object):
+    """
+    The BackgroundHasher class wraps a hash object so that the blocks of a
+    download are hashed on a thread of their own. The download only queues
+    each block, and hashlib releases the GIL while hashing large blocks, so
+    hashing one block overlaps with downloading the next. The queue is
+    bounded, so a download can only get a few blocks ahead of the hashing.
+    """
+    def __init__(self, md5, queue_size=HASH_QUEUE_SIZE):
+        """
+        Constructor for the BackgroundHasher class.
+        """
+        self.md5 = md5
+
+        self._queue = queue.Queue(maxsize=queue_size)
+
+        self._thread = threading.Thread(target=self._hasher, name='hasher', daemon=True)
+        self._thread.start()
+
+    def update(self, data):
+        """
+        Queue a block of data to be hashed.
+        """
+        if isinstance(data, bytes):
+            self._queue.put(data)
+        else:
+            # Views, mappings and buffers may change or go away once this
+            # returns, so they're hashed right away, after the blocks queued
+            # before them.
+            self._queue.join()
+            self.md5.update(data)
+
+    def hexdigest(self):
+        """
+        Wait for every queued block to be hashed and return the digest.
+        """
+        self.close()
+
+        return self.md5.hexdigest()
+
+    def close(self):
+        """
+        Wait for every queued block to be hashed and stop the thread. Safe to
+        call more than once.
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _hasher(self):
+        """
+        Hash the queued blocks in order until told to stop.
+        """
+        update = self.md5.update
+
+        while True:
+            data = self._queue.get()
+
+            try:
+                if data is None:
+                    break
+
+                update(data)
+            finally:
+                self._queue.task_done()
+
+def read_meta(local_path):
+    """
+    Read the details of the remote file recorded when the download of the
+    local file began, or None if there are none.
+    """
+    try:
+        with open(_meta_path(local_path)) as meta_file:
+            return json.load(meta_file)
+    except (IOError, ValueError):
+        return None
+
+def write_meta(local_path, meta):
+    """
+    Record the details of the remote file that the local file is being
+    downloaded from, so that a resumed download can tell if it changed.
+    """
+    with open(_meta_path(local_path), 'w') as meta_file:
+        json.dump(meta, meta_file)
+
+def discard_partial(local_path):
+    """
+    Remove a partially downloaded file, along with the files used to track
+    its progress.
+    """
+    if os.path.exists(local_path):
+        os.remove(local_path)
+
+    remove_tracking(local_path)
+
+def remove_tracking(local_path):
+    """
+    Remove the files used to track the progress of a download, such as those
+    left behind by a client that failed before another completed the file.
+    """
+    for file_path in (_index_path(local_path), _meta_path(local_path)):
+        if os.path.exists(file_path):
+            os.remove(file_path)
+
+def in_ranged_download(local_path):
+    """
+    Determine if the local file belongs to a ranged download that hasn't
+    completed. Such a file is already its full size, gaps and all, so only
+    a ranged download can carry on from it.
+    """
+    return os.path.exists(_index_path(local_path))
+
+def remove_meta(local_path):
+    """
+    Remove the details recorded for a download once it has completed.
+    """
+    meta_path = _meta_path(local_path)
+
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+def _meta_path(local_path):
+    """
+    The path of the file recording the details of the remote file.
+    """
+    return "{0}.meta".format(local_path)
+
+def _index_path(local_path):
+    """
+    The path of the index file that tracks the ranges of a local file.
+    """
+    return "{0}.idx".format(local_path)
+
+def update_from_file(md5, file_path):
+    """
+    Feed the contents of a local file to an existing hash object. Used when
+    the data could not be hashed as it was downloaded, such as the part of a
+    file left behind by an earlier, interrupted download.
+    """
+    # Let hashlib read the file and update the hash in C, rather than
+    # feeding it small chunks from Python.
+    with open(file_path, 'rb') as filehandle:
+        if hasattr(hashlib, 'file_digest'):
+            hashlib.file_digest(filehandle, lambda: md5)
+        elif os.fstat(filehandle.fileno()).st_size > 0:
+            # Python < 3.11. Mapping the file lets it be hashed in a single
+            # update() call. Empty files cannot be mapped.
+            with mmap.mmap(filehandle.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                md5.update(mapped)
@@ -20,7 +20,8 @@ setup(
     author_email='victor73@github.com',
     license='MIT',
     install_requires=[
-        'boto >= 2.49.0',
+        'boto3 >= 1.9.0',
+        'urllib3 >= 1.24',
         'google-auth-oauthlib >= 0.2.0',
         'google-cloud-storage >= 1.13.2'
     ],
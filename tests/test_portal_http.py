@@ -0,0 +1,122 @@
+"""
+Tests for the HTTP client, run against a local web server.
+"""
+
+import gzip
+import hashlib
+import http.server
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'lib'))
+
+from portal_http import PortalHTTP
+from transfer import MIN_RANGED_SIZE
+
+class GzipHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Serves the files in the server's 'files' dictionary, labelling .gz files
+    with a Content-Encoding of gzip whether or not the client asked for it.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._send(False)
+
+    def do_GET(self):
+        self._send(True)
+
+    def _send(self, include_body):
+        data = self.server.files[self.path.lstrip('/')]
+
+        rng = self.headers.get('Range')
+
+        if rng is not None:
+            match = re.match(r'bytes=(\d+)-(\d*)', rng)
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(data) - 1
+            body = data[start:end + 1]
+
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {0}-{1}/{2}'
+                             .format(start, end, len(data)))
+        else:
+            body = data
+
+            self.send_response(200)
+
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', '"gz"')
+
+        if self.path.endswith('.gz'):
+            self.send_header('Content-Encoding', 'gzip')
+
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        if include_body:
+            self.wfile.write(body)
+
+class TestContentEncoding(unittest.TestCase):
+    """
+    Files must be saved exactly as served, even when the server claims they
+    are gzip encoded.
+    """
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), GzipHandler)
+        cls.server.daemon_threads = True
+
+        cls.server.files = {
+            'small.gz': gzip.compress(b'portal_client ' * 1000),
+            # Large enough to be downloaded as concurrently fetched ranges
+            'large.gz': gzip.compress(os.urandom(MIN_RANGED_SIZE + 1024 * 1024),
+                                      compresslevel=1)
+        }
+
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+        cls.base_url = 'http://127.0.0.1:{}/'.format(cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _download(self, name, connections):
+        client = PortalHTTP(connections=connections)
+        local_path = os.path.join(self.tmp_dir, name)
+        md5 = hashlib.md5()
+
+        client.download_file(self.base_url + name, local_path, md5)
+
+        with open(local_path, 'rb') as local_file:
+            saved = local_file.read()
+
+        raw = self.server.files[name]
+
+        self.assertEqual(saved, raw)
+        self.assertEqual(md5.hexdigest(), hashlib.md5(raw).hexdigest())
+
+    def test_gzip_body_saved_raw(self):
+        self._download('small.gz', connections=1)
+
+    def test_gzip_body_saved_raw_in_ranges(self):
+        self._download('large.gz', connections=4)
+
+if __name__ == '__main__':
+    unittest.main()